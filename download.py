@@ -1,20 +1,26 @@
 import argparse
 import asyncio
+import concurrent.futures
 import io
 import logging
-import math
+import os
 import pathlib
+import random
+import re
 import sys
+import tempfile
 import typing
 
-import bs4
 import httpx
-import urlobject
+import lxml.html
+import numpy as np
 from PIL import Image
 
 BLOCK_SIZE = 256
-PER_REQUEST_DELAY_SECONDS = 0.2
 SLEEP_DELAY_ON_ERROR_SECONDS = 180
+# with exponential backoff capped at SLEEP_DELAY_ON_ERROR_SECONDS this retries for about 7 minutes, which rides out
+# rate-limiting that isn't announced with a Retry-After header
+MAX_DOWNLOAD_ATTEMPTS = 10
 DEFAULT_WORKER_TASK_COUNT = 2
 
 # setup the logger
@@ -32,196 +38,432 @@ def get_arguments() -> argparse.Namespace:
     return parser.parse_args()
 
 
-def generate_blocks(
-        width: int, height: int, block_size: int
-) -> typing.MutableSequence[typing.Tuple[int, int, int, int]]:
+def generate_blocks(width: int, height: int, block_size: int) -> np.ndarray:
     """
-    Create a list of blocks defined by their x, y position and the dimensions of the block.
+    Create an array of blocks defined by their x, y position and the dimensions of the block.
 
     :param width: width of the image
     :param height: height of the image
     :param block_size: width and height of a single (square) block
-    :return:
-    """
-    blocks = []
-
-    # these are the regular blocks
-    for j in range(height // block_size):
-        y = block_size * j
-        for i in range(math.ceil(width / block_size)):
-            x = block_size * i
-            blocks.append((x, y, block_size, block_size))
-        tup = blocks.pop()
-        # right edge might be smaller
-        blocks.append((tup[0], tup[1], width - tup[0], block_size))
-
-    # bottom row might be smaller too
-    y = block_size * (j + 1)
-    block_size_height = height - y
-    for i in range(math.ceil(width / block_size)):
-        x = block_size * i
-        blocks.append((x, y, block_size, block_size_height))
-    tup = blocks.pop()
-    blocks.append((tup[0], tup[1], width - tup[0], block_size_height))
-    logger.info(f"Generated {len(blocks)} blocks, last block: {blocks[-1]}")
+    :return: (N, 4) array with a x, y, width, height row per block
+    """
+    xs, ys = np.meshgrid(
+        np.arange(0, width, block_size), np.arange(0, height, block_size)
+    )
+    # blocks on the right and bottom edge might be smaller
+    widths = np.minimum(block_size, width - xs)
+    heights = np.minimum(block_size, height - ys)
+
+    blocks = np.stack([xs, ys, widths, heights], axis=-1).reshape(-1, 4)
+    logger.info(f"Generated {len(blocks)} blocks, last block: {tuple(blocks[-1].tolist())}")
     return blocks
 
 
-def generate_url(
-        x_pos: int, y_pos: int, x_size: int, y_size: int, base_url: urlobject.URLObject
-) -> urlobject.URLObject:
+def generate_url_template(url_prefix: str, tile_format: str = "jpg") -> str:
     """
-    Generate url for a specific block. The urls look like this
+    Generate the url template for the blocks of an image. Only the position and size differ per block, so the rest
+    of the url is baked in once and a block url is made with a single % format:
 
+    template % (x_pos, y_pos, x_size, y_size, x_size)
+
+    The urls look like this
     https://www.artic.edu/iiif/2/831a05de-d3f6-f4fa-a460-23008dd58dda/0,0,256,256/256,/0/default.jpg
 
     The last image is not full width/height
     https://www.artic.edu/iiif/2/831a05de-d3f6-f4fa-a460-23008dd58dda/10752,0,65,256/65,/0/default.jpg
 
-    :param x_pos:
-    :param y_pos:
-    :param x_size:
-    :param y_size:
-    :param base_url:
-    :return: urlobject.URLObject
+    :param url_prefix: IIIF url of the image without a trailing slash
+    :param tile_format: image format to request the blocks in (e.g. jpg, png)
+    :return: str
     """
+    # escape percent-encoded characters in the url, they are not placeholders
+    url_prefix = url_prefix.replace("%", "%%")
+    # don't know what the 0 means (maybe a filter?)
+    return f"{url_prefix}/%d,%d,%d,%d/%d,/0/default.{tile_format}"
 
-    obj = base_url
-    path = obj.path.split("/")
-
-    path.extend(
-        [f"{x_pos},{y_pos},{x_size},{y_size}", f"{x_size},", "0", "default.jpg"]
-    )  # don't know what the 0 means (maybe a filter?)
-
-    new_url = obj.with_path("/".join(path))
-    return new_url
 
-
-def extract_data(url: str) -> (int, int, urlobject.URLObject, pathlib.Path):
+async def extract_data(
+        client: httpx.AsyncClient, url: str
+) -> (int, int, str, pathlib.Path, str):
     """
     Extract metadata from url
 
+    :param client: client to fetch the page with
     :param url: url to extract metadata from
-    :return:  width, height, urlobject, filename
+    :return:  width, height, IIIF url, filename, download url
     """
-    response = httpx.get(url)
+    response = await client.get(url)
 
     if response.status_code != 200:
         raise Exception(f"Did not receive a HTTP 200 ({response.status_code})")
 
-    soup = bs4.BeautifulSoup(response.text, "lxml")
-    buttons = soup.find_all("button", attrs={"data-gallery-img-width": True})
-
-    button = buttons[-1]
+    root = lxml.html.fromstring(response.text)
+    button = root.xpath("(//button[@data-gallery-img-width])[last()]")[0]
 
-    image_width = int(button["data-gallery-img-width"])
-    image_height = int(button["data-gallery-img-height"])
-    download_name = pathlib.Path(button["data-gallery-img-download-name"])
+    image_width = int(button.get("data-gallery-img-width"))
+    image_height = int(button.get("data-gallery-img-height"))
+    download_name = pathlib.Path(button.get("data-gallery-img-download-name"))
     # looks something like https://www.artic.edu/iiif/2/831a05de-d3f6-f4fa-a460-23008dd58dda
-    base_url = urlobject.URLObject(button["data-gallery-img-iiifid"])
+    base_url = button.get("data-gallery-img-iiifid").rstrip("/")
+    # looks something like https://www.artic.edu/iiif/2/831a05de-d3f6-f4fa-a460-23008dd58dda/full/!3000,3000/0/default.jpg
+    download_url = button.get("data-gallery-img-download-url")
+
+    return image_width, image_height, base_url, download_name, download_url
 
-    response = httpx.get(base_url.add_path_segment("info.json"))
+
+async def get_tile_format(client: httpx.AsyncClient, base_url: str, file_format: str) -> str:
+    """
+    Pick the format to request the blocks in. Blocks are requested as jpg, which is several times smaller and faster
+    to decode than png. Only when saving a png, and the IIIF server supports it, are the blocks requested as png so the
+    saved image is lossless.
+
+    :param client: client to fetch the image information with
+    :param base_url: IIIF url of the image without a trailing slash
+    :param file_format: format the final image is saved in
+    :return: tile format
+    """
+    if file_format != "png":
+        # the final jpg is lossy anyway, no need to look up the supported formats
+        return "jpg"
+
+    response = await client.get(f"{base_url}/info.json")
     data = response.json()
-    logger.info(
-        f"{data['width']} x {data['height']}, supported formats: {data['profile'][1]['formats']}"
-    )
-    return image_width, image_height, base_url, download_name
+    formats = data["profile"][1]["formats"]
+    logger.info(f"{data['width']} x {data['height']}, supported formats: {formats}")
 
+    return "png" if "png" in formats else "jpg"
 
-async def worker(
-        worker_name: str, queue: asyncio.queues.Queue, out_queue: asyncio.queues.Queue
-) -> None:
-    # create a single client per worker
-    client = httpx.AsyncClient()
-    while True:
-        try:
-            x_pos, y_pos, x_size, y_size, base_url = queue.get_nowait()
-            await asyncio.sleep(0.1)
-        except asyncio.QueueEmpty:
-            await client.aclose()
-            break
 
-        img_url: urlobject.URLObject = generate_url(
-            x_pos, y_pos, x_size, y_size, base_url
-        )
+def get_download_limit(download_url: typing.Optional[str]) -> typing.Optional[typing.Tuple[int, int]]:
+    """
+    Get the maximum dimensions of the server rendered image from its url, e.g. (3000, 3000) for
+    https://www.artic.edu/iiif/2/831a05de-d3f6-f4fa-a460-23008dd58dda/full/!3000,3000/0/default.jpg
 
-        image_bytes = io.BytesIO()
-        while True:
-            async with client.stream("GET", img_url) as response:
-                if response.status_code != 200:
-                    logger.info(
-                        f"Sleeping for {SLEEP_DELAY_ON_ERROR_SECONDS} seconds due to rate-limiting ({worker_name})"
-                    )
-                    await asyncio.sleep(SLEEP_DELAY_ON_ERROR_SECONDS)
-                    continue
+    :param download_url: url of the server rendered image
+    :return: maximum width and height, None if they can't be determined
+    """
+    match = re.search(r"/full/!(\d+),(\d+)/", download_url or "")
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def decode_block(image_bytes: io.BytesIO) -> np.ndarray:
+    """
+    Decode a downloaded block. This is CPU bound, so it is meant to be run in an executor.
+
+    :param image_bytes: encoded image data
+    :return: (height, width, 3) array with the pixels of the block
+    """
+    with Image.open(image_bytes) as image:
+        return np.asarray(image.convert("RGB"))
+
+
+def get_retry_delay(attempt: int, response: typing.Optional[httpx.Response] = None) -> float:
+    """
+    Determine how long to back off before retrying a failed request. The server's Retry-After header is
+    honored for rate-limiting responses, otherwise the delay grows exponentially (with some jitter) with each attempt.
+    Either way the delay is capped at SLEEP_DELAY_ON_ERROR_SECONDS, so a single block can't stall its worker for hours.
+
+    :param attempt: number of attempts that already failed for this request
+    :param response: the failed response, None if no response was received at all
+    :return: delay in seconds
+    """
+    if response is not None and response.status_code in (429, 503):
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), SLEEP_DELAY_ON_ERROR_SECONDS)
+    return min(SLEEP_DELAY_ON_ERROR_SECONDS, 2 ** attempt) + random.random()
 
+
+async def download_block(
+        client: httpx.AsyncClient, img_url: str, worker_name: str
+) -> typing.Optional[io.BytesIO]:
+    """
+    Download a single block, retrying with a backoff on errors.
+
+    :param client: client to download with
+    :param img_url: url of the block
+    :param worker_name: name of the worker, used for logging
+    :return: the encoded block, None if it could not be downloaded within MAX_DOWNLOAD_ATTEMPTS
+    """
+    for attempt in range(MAX_DOWNLOAD_ATTEMPTS):
+        response = None
+        try:
+            async with client.stream("GET", img_url) as response:
+                response.raise_for_status()
+                image_bytes = io.BytesIO()
                 async for chunk in response.aiter_bytes():
                     image_bytes.write(chunk)
+                return image_bytes
+        except httpx.HTTPStatusError as e:
+            reason = f"HTTP {e.response.status_code}"
+            if e.response.status_code == 404:
+                # retrying won't make it appear
                 break
+        except httpx.TransportError as e:
+            reason = repr(e)
 
-        await out_queue.put((x_pos, y_pos, image_bytes))
+        if attempt + 1 < MAX_DOWNLOAD_ATTEMPTS:
+            delay = get_retry_delay(attempt, response)
+            logger.info(f"Sleeping for {delay:.1f} seconds due to {reason} ({worker_name})")
+            await asyncio.sleep(delay)
 
-        qsize = out_queue.qsize()
-        if qsize % 100 == 0:
-            logger.info(f"Downloaded {qsize} image parts...")
+    logger.warning(f"Giving up on {img_url} ({reason}, {worker_name})")
+    return None
 
-        # Notify the queue that the "work item" has been processed.
-        queue.task_done()
 
+async def producer(queue: asyncio.queues.Queue, blocks: np.ndarray, workers: int) -> None:
+    """
+    Feed blocks to the download workers. The queue is bounded, so blocks are only handed out as fast as they are
+    downloaded. One None sentinel per worker signals the end of the work.
 
-async def main(url: str, workers: int, file_format: str) -> None:
-    max_width, max_height, base_url, download_name = extract_data(url)
-    logger.info(f"Starting download of {download_name} ({file_format})")
-    logger.info(f"Hi-res image is {max_width}x{max_height}. {base_url}")
+    :param queue: queue the download workers consume from
+    :param blocks: blocks to download
+    :param workers: number of workers consuming from the queue
+    """
+    for block in blocks:
+        x_pos, y_pos, x_size, y_size = block.tolist()
+        await queue.put((x_pos, y_pos, x_size, y_size))
 
-    # Create a queue that we will use to store our workload.
-    queue = asyncio.Queue()
-    out_queue = asyncio.Queue()
+    for _ in range(workers):
+        await queue.put(None)
 
-    blocks = generate_blocks(max_width, max_height, BLOCK_SIZE)
-    logger.info(f"Need to download {len(blocks)} image parts...")
 
-    for x_pos, y_pos, x_size, y_size in blocks:
-        queue.put_nowait((x_pos, y_pos, x_size, y_size, base_url))
+async def close_stage(
+        tasks: typing.Sequence[asyncio.Task], queue: asyncio.queues.Queue, consumers: int
+) -> None:
+    """
+    Wait for all tasks of a pipeline stage to finish, then put one None sentinel per consumer of the next stage.
 
-    # Create some worker tasks to process the queue concurrently.
-    tasks = []
-    logger.info(f"Creating {workers} workers")
-    for i in range(workers):
-        task = asyncio.create_task(worker(f"worker-{i}", queue, out_queue))
-        tasks.append(task)
+    :param tasks: tasks of the stage that feed the queue
+    :param queue: queue the next stage consumes from
+    :param consumers: number of consumers of the next stage
+    """
+    await asyncio.gather(*tasks)
+    for _ in range(consumers):
+        await queue.put(None)
 
-    logger.info("Waiting for download to finish...")
-    await queue.join()
 
-    # Cancel worker tasks.
-    for task in tasks:
-        task.cancel()
+async def download_worker(
+        worker_name: str,
+        client: httpx.AsyncClient,
+        block_queue: asyncio.queues.Queue,
+        decode_queue: asyncio.queues.Queue,
+        url_template: str,
+) -> None:
+    while True:
+        item = await block_queue.get()
+        if item is None:
+            # the producer is done
+            break
 
-    # Wait until all worker tasks are cancelled.
-    await asyncio.gather(*tasks, return_exceptions=True)
+        x_pos, y_pos, x_size, y_size = item
+        img_url = url_template % (x_pos, y_pos, x_size, y_size, x_size)
 
-    # Create the destination image
-    logger.info(f"Stitching {len(blocks)} parts together to create final image")
-    destination = Image.new("RGB", (max_width, max_height))
+        image_bytes = await download_block(client, img_url, worker_name)
+        if image_bytes is None:
+            # leave the block blank rather than stall or abort the whole download
+            continue
 
+        await decode_queue.put((x_pos, y_pos, image_bytes))
+
+
+async def decode_worker(
+        decode_queue: asyncio.queues.Queue,
+        paste_queue: asyncio.queues.Queue,
+        pool: concurrent.futures.ThreadPoolExecutor,
+) -> None:
+    loop = asyncio.get_running_loop()
     while True:
-        # Paste all image blocks into the final image based on their x, y offset
-        x_pos, y_pos, image_bytes = await out_queue.get()
-        destination.paste(Image.open(image_bytes), (x_pos, y_pos))
-        out_queue.task_done()
+        item = await decode_queue.get()
+        if item is None:
+            # all downloads are done
+            break
+
+        x_pos, y_pos, image_bytes = item
+        # Decode in the pool so downloads continue in the meantime
+        block = await loop.run_in_executor(pool, decode_block, image_bytes)
+        image_bytes.close()
+        await paste_queue.put((x_pos, y_pos, block))
 
-        if out_queue.empty():
+
+async def stitch_worker(paste_queue: asyncio.queues.Queue, canvas: np.ndarray, total: int) -> int:
+    stitched = 0
+    while True:
+        item = await paste_queue.get()
+        if item is None:
+            # all blocks are decoded
             break
 
-    logger.info(f"Saving final image {download_name}")
-    if not download_name.suffix == ".jpg":
-        download_name = download_name.with_suffix(".jpg")
+        x_pos, y_pos, block = item
+        canvas[y_pos: y_pos + block.shape[0], x_pos: x_pos + block.shape[1], :3] = block
+
+        stitched += 1
+        if stitched % 100 == 0:
+            logger.info(f"Stitched {stitched} of {total} image parts...")
+
+    if stitched < total:
+        logger.warning(f"{total - stitched} of {total} image parts could not be downloaded and are left blank")
+    return total - stitched
+
+
+async def download_image(
+        client: httpx.AsyncClient,
+        canvas: np.ndarray,
+        base_url: str,
+        tile_format: str,
+        workers: int,
+) -> int:
+    """
+    Download all blocks of the image and stitch them together.
+
+    :param client: client to download with
+    :param canvas: zero-filled (height, width, 4) RGBX array the blocks are pasted into. Blocks that fail to download
+        stay black.
+    :param base_url: IIIF url of the image without a trailing slash
+    :param tile_format: image format to request the blocks in
+    :param workers: number of download workers
+    :return: number of blocks that could not be downloaded
+    """
+    max_height, max_width, _ = canvas.shape
+    blocks = generate_blocks(max_width, max_height, BLOCK_SIZE)
+    logger.info(f"Need to download {len(blocks)} image parts...")
 
-    final_path = "output" / download_name
-    destination.save(final_path)
+    url_template = generate_url_template(base_url, tile_format)
+
+    # The stages of the pipeline are connected by bounded queues, so no stage can run far ahead of the next one
+    # os.cpu_count() returns None when the number of CPUs can't be determined
+    decoders = os.cpu_count() or 1
+    block_queue = asyncio.Queue(maxsize=workers * 4)
+    decode_queue = asyncio.Queue(maxsize=workers * 2)
+    paste_queue = asyncio.Queue(maxsize=workers * 2)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=decoders) as pool:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(producer(block_queue, blocks, workers))
+
+            logger.info(f"Creating {workers} download workers and {decoders} decode workers")
+            download_tasks = [
+                tg.create_task(
+                    download_worker(f"worker-{i}", client, block_queue, decode_queue, url_template)
+                )
+                for i in range(workers)
+            ]
+            tg.create_task(close_stage(download_tasks, decode_queue, decoders))
+
+            decode_tasks = [
+                tg.create_task(decode_worker(decode_queue, paste_queue, pool))
+                for _ in range(decoders)
+            ]
+            tg.create_task(close_stage(decode_tasks, paste_queue, 1))
+
+            stitch_task = tg.create_task(stitch_worker(paste_queue, canvas, len(blocks)))
+            logger.info("Waiting for download to finish...")
+
+    return stitch_task.result()
+
+
+async def download_full_image(client: httpx.AsyncClient, base_url: str, final_path: pathlib.Path) -> None:
+    """
+    Stream the server rendered image in its native size straight to disk. The image is written under a temporary name
+    first and only moved into place once it is complete, so a failed download never leaves a truncated image behind.
+
+    :param client: client to download with
+    :param base_url: IIIF url of the image without a trailing slash
+    :param final_path: where to save the image
+    """
+    # full/full is the whole image at its native size, unlike the !w,h size of the gallery download url which a
+    # server may scale to fit the box
+    full_url = f"{base_url}/full/full/0/default.jpg"
+    partial_path = final_path.with_name(f"{final_path.name}.part")
+    try:
+        async with client.stream("GET", full_url) as response:
+            response.raise_for_status()
+            with open(partial_path, "wb") as f:
+                async for chunk in response.aiter_bytes():
+                    f.write(chunk)
+    except BaseException:
+        partial_path.unlink(missing_ok=True)
+        raise
+
+    os.replace(partial_path, final_path)
+
+
+def save_image(canvas: np.ndarray, final_path: pathlib.Path, file_format: str) -> None:
+    """
+    Save the stitched image.
+
+    :param canvas: (height, width, 4) RGBX array holding the image
+    :param final_path: where to save the image
+    :param file_format: jpg or png
+    """
+    height, width, _ = canvas.shape
+    # Pillow only maps a buffer without copying it for a few modes, RGBX is one of them but RGB is not
+    image = Image.frombuffer("RGBX", (width, height), canvas, "raw", "RGBX", 0, 1)
+    if file_format == "png":
+        # png can't store RGBX, so this makes a full RGB copy of the image on the heap
+        image = image.convert("RGB")
+        # the lowest compression level is by far the fastest and the files are only slightly larger
+        image.save(final_path, "PNG", compress_level=1)
+    else:
+        # baseline (not progressive) encoding, keep full chroma resolution as the blocks are already lossy
+        image.save(final_path, "JPEG", quality=95, subsampling=0)
+
+
+async def main(url: str, workers: int, file_format: str) -> int:
+    # A single client shared by all requests, so connections are reused (and multiplexed over HTTP/2)
+    limits = httpx.Limits(
+        max_connections=workers * 4,
+        max_keepalive_connections=workers * 4,
+        keepalive_expiry=60,
+    )
+    timeout = httpx.Timeout(connect=5, read=60, write=10, pool=10)
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=timeout) as client:
+        max_width, max_height, base_url, download_name, download_url = await extract_data(client, url)
+        logger.info(f"Starting download of {download_name} ({file_format})")
+        logger.info(f"Hi-res image is {max_width}x{max_height}. {base_url}")
+
+        if not download_name.suffix == f".{file_format}":
+            download_name = download_name.with_suffix(f".{file_format}")
+        final_path = "output" / download_name
+
+        download_limit = get_download_limit(download_url)
+        fits_download_limit = (
+            download_limit is not None and max_width <= download_limit[0] and max_height <= download_limit[1]
+        )
+        if file_format == "jpg" and fits_download_limit:
+            # the server renders the image in full resolution, no need to stitch it together ourselves
+            logger.info(f"Saving full image {download_name}")
+            try:
+                await download_full_image(client, base_url, final_path)
+                return 0
+            except httpx.HTTPError as e:
+                logger.warning(f"Could not download the full image ({e!r}), downloading it in parts instead")
+
+        # the image information is only needed when downloading blocks
+        tile_format = await get_tile_format(client, base_url, file_format)
+
+        # The canvas is backed by a temporary file rather than the heap, so the OS can page it out. It is RGBX rather
+        # than RGB, so Pillow can encode a jpg straight from it without copying the image into memory. A png still
+        # needs a full copy.
+        with tempfile.TemporaryFile(dir="output") as canvas_file:
+            canvas = np.memmap(canvas_file, dtype=np.uint8, mode="w+", shape=(max_height, max_width, 4))
+            missing = await download_image(client, canvas, base_url, tile_format, workers)
+            if missing:
+                # don't pass off an image with blank parts as the finished download
+                final_path = final_path.with_name(f"{final_path.stem}.partial{final_path.suffix}")
+
+            logger.info(f"Saving final image {final_path.name}")
+            # encoding a large image takes seconds, keep the event loop responsive in the meantime
+            await asyncio.to_thread(save_image, canvas, final_path, file_format)
+
+    if missing:
+        logger.error(f"Saved incomplete image to {final_path}, {missing} image parts are missing")
+        return 1
+    return 0
 
 
 if __name__ == "__main__":
     args = get_arguments()
-    asyncio.run(main(args.url, args.workers, args.format))
+    sys.exit(asyncio.run(main(args.url, args.workers, args.format)))